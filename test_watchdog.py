@@ -1,4 +1,7 @@
 from watchdog import WatchDog
+import utils
+import numpy as np
+import skimage.io as io
 
 def main():
 
@@ -12,6 +15,20 @@ def main():
     rendered_im = watchdog.render_mesh(mesh, real_im.shape[1], real_im.shape[0])
     watchdog.test_compare_images(real_im, rendered_im)
 
+def test_duplicate_point_line():
+    # A travel move followed by an extrusion starting at the same XY gives a line with the same point twice
+    line = [[20.0, 20.0, 0.2], [20.0, 20.0, 0.2], [30.0, 20.0, 0.2]]
+
+    watchdog = WatchDog([273.7, -5, 15.0], [1.123, 0.05, 0.85], np.pi/3.0, 1.0, 0.4, [0.0,0.0,1.0])
+    mesh = watchdog.build_object_mesh([[line]], [], 1)
+    assert mesh.vertices.shape == (8, 3)
+    assert np.all(np.isfinite(mesh.vertices))
+
+    # The kernel itself has to stay finite too, even when given the duplicate
+    vertices, indices = utils.extrude_lines(np.array(line), np.array([3]), 0.2, 0.2)
+    assert vertices.shape == (12, 3)
+    assert np.all(np.isfinite(vertices))
+
 
 if __name__ == "__main__":
     main()
@@ -1,31 +1,14 @@
+import math
 import pyrender
 from io import BytesIO
 import numpy as np
+from numba import njit
 import trimesh
 import requests
 import matplotlib.pyplot as plt
 
-def rotate_vector(vector, angle):
-    '''
-    Rotates a vector by a given angle.
-    '''
-    return [vector[0]*np.cos(angle) - vector[1]*np.sin(angle), vector[0]*np.sin(angle) + vector[1]*np.cos(angle)]
-
-def scale_vector(vector, length):
-    '''
-    Scales a vector to be a certain length.
-    '''
-    mag = np.sqrt(vector[0]**2 + vector[1]**2)
-    vector = length*(np.array(vector)/mag)
-    return vector
-
-def add_vector_bi(vector, point):
-    '''
-    Takes a vector and point, returns point + vector and point - vector
-    '''
-    new_point_pos = [point[0] + vector[0], point[1] + vector[1], point[2]]
-    new_point_neg = [point[0] - vector[0], point[1] - vector[1], point[2]]
-    return (new_point_pos, new_point_neg)
+#How close to the 0 vector two added normals can be before we treat them as pointing in opposite directions
+_ANTIPARALLEL_EPSILON = 1e-9
 
 def get_corner_normals(line, line_width):
     '''
@@ -34,101 +17,129 @@ def get_corner_normals(line, line_width):
     does this by going across the given line and expanding outwards from each
     point of the line (hence 'corner_normals', as it's getting points normal to
     the general direction of the line at any given point)
+    Works on the whole line at once as an (N, 3) array, and returns a (2N, 3)
+    array where rows 2i and 2i+1 are point i pushed out in either direction.
+    No two points in a row can have the same x and y, since there's no direction
+    to push out from a segment with no length, and those points come out as NaN.
+    extrude_lines handles this case instead, and is what build_object_mesh uses.
     '''
 
-    result = []
-
     # TODO: make width be based on variable, on extrusion amount
     width = line_width
 
-    if len(line) > 1:
-
-        #Getting vector normal to very first line, to get our starting points
-        first_normal = scale_vector(rotate_vector([line[1][0] - line[0][0], line[1][1] - line[0][1]], np.pi/2), width)
-        start_points = add_vector_bi(first_normal, line[0])
-        result.append(start_points[0])
-        result.append(start_points[1])
-
-        for i in range(1, len(line) - 1):
-            #Getting the points before and after the current point in the line
-            last_point = line[i - 1]
-            current_point = line[i]
-            next_point = line[i + 1]
-
-            """
-            Getting the vectors between the last and next points, effectiely
-            getting each line segment before and after our current point
-            """
-            last_dif = [current_point[0] - last_point[0], current_point[1] - last_point[1]]
-            next_dif = [current_point[0] - next_point[0], current_point[1] - next_point[1]]
-
-            """
-            Getting vectors normal to the lines above. I rotate by 90° instead
-            of actually doing a normal calculation because the formulas to find
-            normals I found were never reliable; the normals generated would
-            sometimes be on one side or another of the line, and this messes
-            things up later on.
-            """
-            last_normal = rotate_vector(last_dif, np.pi/2)
-            next_normal = rotate_vector(next_dif, -np.pi/2)
-
-            normal = []
-
-            """
-            We want to now add both normals together to get the final combined
-            normal. However, if both difference vectors are negatives of eachother,
-            the result will be the 0 vector and mess everything up, so we check for
-            that here. This can often be a problem when there's a stretch of line
-            that's completely horizontal or completely vertical.
-            """
-            if last_normal[0] == next_normal[0]*-1 and last_normal[1] == next_normal[1]*-1:
-                normal = last_normal
-            else:
-                normal = [(last_normal[0] + next_normal[0]), (last_normal[1] + next_normal[1])]
+    line = np.asarray(line, dtype=np.float64)
 
-            #Scaling result back to width
-            magnitude = np.sqrt(normal[0]**2 + normal[1]**2)
-            normal = [(normal[0] / magnitude) * width, (normal[1] / magnitude) * width]
+    if len(line) < 2:
+        return np.empty((0, 3))
 
-            #Adds the normal on to the current_point, in both directions, to get our new corner points
-            corner_points = add_vector_bi(normal, current_point)
+    #Vectors along each line segment, rotated by 90° to get the normal of each segment
+    segments = np.diff(line[:, :2], axis=0)
+    segment_normals = np.stack([-segments[:, 1], segments[:, 0]], axis=1)
 
-            result.append(corner_points[0])
-            result.append(corner_points[1])
+    normals = np.empty((len(line), 2))
 
-        #Getting vector normal to very last line, to get our ending points
-        last_normal = scale_vector(rotate_vector([line[-1][0] - line[-2][0], line[-1][1] - line[-2][1]], np.pi/2), width)
-        end_points = add_vector_bi(last_normal, line[-1])
-        result.append(end_points[0])
-        result.append(end_points[1])
+    #The very first and very last points just use the normal of their only segment
+    normals[0] = segment_normals[0]
+    normals[-1] = segment_normals[-1]
 
-    return result
+    """
+    Every point in between gets the normals of the segments before and after it
+    added together. If both segments are negatives of eachother, the result
+    will be the 0 vector and mess everything up, so we fall back to the normal
+    of the segment before it. This can often be a problem when there's a
+    stretch of line that's completely horizontal or completely vertical.
+    """
+    last_normals = segment_normals[:-1]
+    combined_normals = last_normals + segment_normals[1:]
+    antiparallel = np.hypot(combined_normals[:, 0], combined_normals[:, 1]) < _ANTIPARALLEL_EPSILON
+    normals[1:-1] = np.where(antiparallel[:, None], last_normals, combined_normals)
 
-def parse_gcode_file(filename, hotend_distance=0):
-    '''
-    Reads a gcode file and generates a series of lines that represent where the
-    extruder(s) would put down material when printing. These lines are defined
-    by when the extruder should stop or start extruding - so from when the hotend
-    starts pushing material out to when it stops is one line. On top of that,
-    each line is organized into layers, each being a list of lines for a given height.
-    hotend_distance is the distance between the two hotends if the printer has
-    multiple. On Ultimakers, a slicer has to compensate for this distance by
-    offseting the position of the head, and setting hotend_distance will compensate
-    for that.
-    Returns two lists of layers of lines representing a 3D object, as defined in a gcode file.
-    The first list has lines made by hotend 0, the second list has lines made by hotend 1. If
-    only one hotend was used, the list for the other will be empty.
-    '''
-    file = open(filename, "r")
+    #Scaling results back to width
+    normals *= width / np.linalg.norm(normals, axis=1, keepdims=True)
 
-    one_layers = []
-    two_layers = []
+    #Adds the normals on to each point, in both directions, to get our new corner points
+    result = np.empty((2*len(line), 3))
+    result[0::2, :2] = line[:, :2] + normals
+    result[1::2, :2] = line[:, :2] - normals
+    result[:, 2] = np.repeat(line[:, 2], 2)
 
-    one_lines = []
-    two_lines = []
+    return result
+
+#Kinds of moves recorded by _parse_gcode_core
+_MOVE_TRAVEL = 0
+_MOVE_EXTRUDE = 1
+_MOVE_NEW_LAYER = 2
 
-    one_new_line = []
-    two_new_line = []
+@njit(cache=True)
+def _parse_gcode_number(buf, start, end):
+    '''
+    Parses a number out of buf[start:end], stopping at the first character that
+    can't be part of it. Handles signs, decimal points and exponents, which is
+    everything that shows up in the gcode we read.
+    '''
+    i = start
+    sign = 1.0
+    if i < end and (buf[i] == 45 or buf[i] == 43): # '-' or '+'
+        if buf[i] == 45:
+            sign = -1.0
+        i += 1
+
+    mantissa = 0
+    fraction_digits = 0
+    digits = 0
+    seen_point = False
+    while i < end:
+        c = buf[i]
+        if c >= 48 and c <= 57: # '0' - '9'
+            mantissa = mantissa*10 + (c - 48)
+            digits += 1
+            if seen_point:
+                fraction_digits += 1
+        elif c == 46 and not seen_point: # '.'
+            seen_point = True
+        else:
+            break
+        i += 1
+
+    if digits == 0:
+        raise ValueError("could not parse number in gcode")
+
+    #Dividing by an exact power of ten gives the same result float() would
+    value = mantissa / 10.0**fraction_digits
+
+    if i + 1 < end and (buf[i] == 101 or buf[i] == 69): # 'e' or 'E'
+        j = i + 1
+        exp_sign = 1
+        if buf[j] == 45 or buf[j] == 43:
+            if buf[j] == 45:
+                exp_sign = -1
+            j += 1
+        exponent = 0
+        exp_digits = 0
+        while j < end and buf[j] >= 48 and buf[j] <= 57:
+            exponent = exponent*10 + (buf[j] - 48)
+            exp_digits += 1
+            j += 1
+        if exp_digits > 0:
+            value = value * 10.0**(exp_sign*exponent)
+
+    return sign*value
+
+@njit(cache=True)
+def _parse_gcode_core(buf, line_starts, line_ends, hotend_distance):
+    '''
+    Walks through the raw bytes of a gcode file and records every move made while
+    printing. buf is the file as a uint8 array, and line_starts/line_ends give
+    where each line of the file begins and ends in buf.
+    Returns the position of each move, the hotend that made it, and what kind
+    of move it was (_MOVE_TRAVEL, _MOVE_EXTRUDE or _MOVE_NEW_LAYER), along with
+    how many moves were recorded.
+    '''
+    line_count = len(line_starts)
+    points = np.empty((line_count, 3))
+    cores = np.empty(line_count, dtype=np.int8)
+    kinds = np.empty(line_count, dtype=np.int8)
+    count = 0
 
     current_x = 0.0
     current_y = 0.0
@@ -137,27 +148,30 @@ def parse_gcode_file(filename, hotend_distance=0):
     last_e = 0.0
     e_change = 0.0
 
-    core_switch_save = [0.0, 0.0, 0.0, 0.0, 0.0, 0.0]
+    core_switch_save = np.zeros(6)
 
     printing = False
 
-
     printcore = 0
 
-    count = 0
-    for line in file:
+    for n in range(line_count):
+        start = line_starts[n]
+        end = line_ends[n]
 
         #Need to check if this line has or is a comment, and shave off the comment or skip it if it is/does, respectively
-        line = line.split(";")[0]
-        if line == "":
+        for i in range(start, end):
+            if buf[i] == 59: # ';'
+                end = i
+                break
+        if end == start:
             continue
 
+        length = end - start
 
         #Checking for when the active core is switched
-        if line[:2] == "T0" or line[:2] == "T1":
-            new_core = int(line[1])
+        if length >= 2 and buf[start] == 84 and (buf[start + 1] == 48 or buf[start + 1] == 49): # 'T0' or 'T1'
+            new_core = int(buf[start + 1]) - 48
             #In case T0 or T1 commands get called for some reason while we're still on the same core
-            #I don't think that'll ever happen but I want the code to work if it does
             if new_core != printcore:
                 """
                 Now we need to switch all of our values to be the ones we want
@@ -165,146 +179,413 @@ def parse_gcode_file(filename, hotend_distance=0):
                 we switch back to the current (soon to be previous) hotend
                 """
                 printcore = new_core
-                current_values = [current_x, current_y, current_z, last_extruded_z, last_e, e_change]
+                saved_x = current_x
+                saved_y = current_y
+                saved_z = current_z
+                saved_extruded_z = last_extruded_z
+                saved_e = last_e
+                saved_e_change = e_change
                 current_x = core_switch_save[0]
                 current_y = core_switch_save[1]
                 current_z = core_switch_save[2]
                 last_extruded_z = core_switch_save[3]
                 last_e = core_switch_save[4]
                 e_change = core_switch_save[5]
-                core_switch_save = current_values
-
+                core_switch_save[0] = saved_x
+                core_switch_save[1] = saved_y
+                core_switch_save[2] = saved_z
+                core_switch_save[3] = saved_extruded_z
+                core_switch_save[4] = saved_e
+                core_switch_save[5] = saved_e_change
 
         #Only start recording once we see this command. M204 prolly would work too.
-        if line[:4] == "M205":
+        if length >= 4 and buf[start] == 77 and buf[start + 1] == 50 and buf[start + 2] == 48 and buf[start + 3] == 53: # 'M205'
             printing = True
 
-        if printing:
-            #G0 or G1 = movement, G0 typically used for non-extrusion, G1 for extrusion
-            if line[:2] == "G0" or line[:2] == "G1":
-
-                parameters = line.split(" ")
-
-                new_x = current_x
-                new_y = current_y
-                new_z = current_z
-                new_e = last_e
-
-                #Going through command parameters to get info out. Can skip first thing in list since it'll just be G0 or G1
-                for p in parameters[1:]:
-                    if p == "":
-                        continue
-
-                    if p[0] == "X":
-                        new_x = float(p[1:])
-                        """
-                        Position of the printhead in gcode doesn't care about
-                        which hotend we're using, so our slicer needs to shift
-                        over a bit so the second hotend is aligned correctly.
-                        Here, we undo this shifting so we record the actual
-                        coordinates that the nozzle moved over.
-                        """
-                        if printcore == 1:
-                            new_x += hotend_distance
-                    elif p[0] == "Y":
-                        new_y = float(p[1:])
-                    elif p[0] == "Z":
-                        new_z = float(p[1:])
-                    elif p[0] == "E":
-                        new_e = float(p[1:])
-
-                did_extrude = False
-                # If E is specified, we're extruding on this move
-                # This is probably not necessary since the code as it is would give 0 e_change for lines without 'E' in them, but I'll leave this in just to be safe
-                if "E" in line and ("X" in line or "Y" in line or "Z" in line):
-
-                    # Check if this extrusion is actually pushing material out of the nozzle
-                    # Need to pay attention to retractions, and how far filament is pulled out of the nozzle at times
-                    # Thus, if e_change becomes negative, we want to keep it negative until there are enough positive changes to bring it back
-                    extrusion_dif = new_e - last_e
-                    if e_change <= 0:
-                        e_change = e_change + extrusion_dif
-                    else:
-                        e_change = extrusion_dif
-
-#                     print(e_change)
-
-                    # Only record these movements if we're actually extruding
-                    if e_change > 0.0:
-                        did_extrude = True
-
-                        #Check if we're starting a new layer, and start adding to a new layer if so
-                        if new_z != last_extruded_z:
-                            if printcore == 0:
-                                one_layers.append(one_lines)
-                                one_lines = []
-                                one_new_line = []
-                            else:
-                                two_layers.append(two_lines)
-                                two_lines = []
-                                two_new_line = []
-                        if printcore == 0:
-                            one_new_line.append([new_x, new_y, new_z])
-                        else:
-                            two_new_line.append([new_x, new_y, new_z])
-                        last_extruded_z = new_z
-
-                #Not extruding on this move, so now start a new line/maybe point(s) if there are multiple non-extrusion moves
-                if not did_extrude:
-                    if printcore == 0:
-                        if len(one_new_line) > 1:
-                            one_lines.append(one_new_line)
-                        one_new_line = []
-                        one_new_line.append([new_x, new_y, new_z])
-                    else:
-                        if len(two_new_line) > 1:
-                            two_lines.append(two_new_line)
-                        two_new_line = []
-                        two_new_line.append([new_x, new_y, new_z])
-
-                current_x = new_x
-                current_y = new_y
-                current_z = new_z
-
-
-    #Removing first layer, since our first command will go to the starting Z coordinate and thus add an empty list to layers
-    one_layers = one_layers[1:]
-    two_layers = two_layers[1:]
-
-    file.close()
+        if not printing:
+            continue
+
+        #G0 or G1 = movement, G0 typically used for non-extrusion, G1 for extrusion
+        if not (length >= 2 and buf[start] == 71 and (buf[start + 1] == 48 or buf[start + 1] == 49)):
+            continue
+
+        new_x = current_x
+        new_y = current_y
+        new_z = current_z
+        new_e = last_e
+
+        has_e = False
+        has_position = False
+
+        #Going through command parameters to get info out. Can skip the first one since it'll just be G0 or G1
+        i = start
+        while i < end and buf[i] != 32: # ' '
+            i += 1
+        while i < end:
+            if buf[i] == 32:
+                i += 1
+                continue
+
+            c = buf[i]
+            if c == 88: # 'X'
+                new_x = _parse_gcode_number(buf, i + 1, end)
+                """
+                Position of the printhead in gcode doesn't care about
+                which hotend we're using, so our slicer needs to shift
+                over a bit so the second hotend is aligned correctly.
+                Here, we undo this shifting so we record the actual
+                coordinates that the nozzle moved over.
+                """
+                if printcore == 1:
+                    new_x += hotend_distance
+            elif c == 89: # 'Y'
+                new_y = _parse_gcode_number(buf, i + 1, end)
+            elif c == 90: # 'Z'
+                new_z = _parse_gcode_number(buf, i + 1, end)
+            elif c == 69: # 'E'
+                new_e = _parse_gcode_number(buf, i + 1, end)
+
+            while i < end and buf[i] != 32:
+                i += 1
+
+        for i in range(start, end):
+            c = buf[i]
+            if c == 69:
+                has_e = True
+            elif c == 88 or c == 89 or c == 90:
+                has_position = True
+
+        did_extrude = False
+        # If E is specified, we're extruding on this move
+        if has_e and has_position:
+
+            # Check if this extrusion is actually pushing material out of the nozzle
+            # Need to pay attention to retractions, and how far filament is pulled out of the nozzle at times
+            # Thus, if e_change becomes negative, we want to keep it negative until there are enough positive changes to bring it back
+            extrusion_dif = new_e - last_e
+            if e_change <= 0:
+                e_change = e_change + extrusion_dif
+            else:
+                e_change = extrusion_dif
+
+            # Only record these movements if we're actually extruding
+            if e_change > 0.0:
+                did_extrude = True
+
+                #Check if we're starting a new layer
+                if new_z != last_extruded_z:
+                    kinds[count] = _MOVE_NEW_LAYER
+                else:
+                    kinds[count] = _MOVE_EXTRUDE
+                last_extruded_z = new_z
+
+        #Not extruding on this move, so now start a new line/maybe point(s) if there are multiple non-extrusion moves
+        if not did_extrude:
+            kinds[count] = _MOVE_TRAVEL
+
+        points[count, 0] = new_x
+        points[count, 1] = new_y
+        points[count, 2] = new_z
+        cores[count] = printcore
+        count += 1
+
+        current_x = new_x
+        current_y = new_y
+        current_z = new_z
+
+    return points, cores, kinds, count
+
+def _split_moves(points, kinds):
+    '''
+    Takes the moves made by a single hotend, as returned by _parse_gcode_core, and
+    splits them up into layers of lines. A line starts at each travel move or new
+    layer and is only kept if it's ended by a later travel move and has more than
+    one point in it.
+    '''
+    layer_count = np.count_nonzero(kinds == _MOVE_NEW_LAYER)
+    if layer_count < 2:
+        return []
+
+    line_starts = np.flatnonzero(kinds != _MOVE_EXTRUDE)
+    if line_starts[0] != 0:
+        line_starts = np.concatenate(([0], line_starts))
+    line_ends = line_starts[1:]
+    line_starts = line_starts[:-1]
+
+    line_layers = np.cumsum(kinds == _MOVE_NEW_LAYER)[line_starts]
+
+    """
+    Lines before the first new layer are dropped, since our first command will
+    go to the starting Z coordinate. Lines after the last new layer are dropped
+    too, since nothing comes after them to finish off that layer.
+    """
+    keep = (kinds[line_ends] == _MOVE_TRAVEL) & (line_ends - line_starts > 1)
+    keep &= (line_layers > 0) & (line_layers < layer_count)
+
+    points = points.tolist()
+    layers = [[] for _ in range(layer_count - 1)]
+    for start, end, layer in zip(line_starts[keep].tolist(), line_ends[keep].tolist(), line_layers[keep].tolist()):
+        layers[layer - 1].append(points[start:end])
+
+    return layers
+
+def parse_gcode_file(filename, hotend_distance=0):
+    '''
+    Reads a gcode file and generates a series of lines that represent where the
+    extruder(s) would put down material when printing. These lines are defined
+    by when the extruder should stop or start extruding - so from when the hotend
+    starts pushing material out to when it stops is one line. On top of that,
+    each line is organized into layers, each being a list of lines for a given height.
+    hotend_distance is the distance between the two hotends if the printer has
+    multiple. On Ultimakers, a slicer has to compensate for this distance by
+    offseting the position of the head, and setting hotend_distance will compensate
+    for that.
+    Returns two lists of layers of lines representing a 3D object, as defined in a gcode file.
+    The first list has lines made by hotend 0, the second list has lines made by hotend 1. If
+    only one hotend was used, the list for the other will be empty.
+    '''
+    #Reading the whole file in at once, and finding where every line starts and ends in one go
+    with open(filename, "rb") as file:
+        buf = np.frombuffer(file.read(), dtype=np.uint8)
+
+    line_ends = np.flatnonzero(buf == 10) # '\n'
+    line_starts = np.concatenate(([0], line_ends + 1))
+    line_ends = np.concatenate((line_ends, [len(buf)]))
+
+    points, cores, kinds, count = _parse_gcode_core(buf, line_starts, line_ends, float(hotend_distance))
+
+    one_layers = _split_moves(points[:count][cores[:count] == 0], kinds[:count][cores[:count] == 0])
+    two_layers = _split_moves(points[:count][cores[:count] == 1], kinds[:count][cores[:count] == 1])
 
     return one_layers, two_layers
 
+def downsample_image(image, factor):
+    '''
+    Shrinks an image down by an integer factor by averaging each factor by factor
+    block of pixels, the same as cv2's INTER_AREA does for whole number factors.
+    Any rows or columns at the edges that don't fill a whole block are dropped.
+    The result stays as uint8.
+    '''
+    image = np.asarray(image)
+    if factor == 1:
+        return image
+
+    height = image.shape[0] // factor
+    width = image.shape[1] // factor
+    blocks = image[:height*factor, :width*factor].reshape((height, factor, width, factor) + image.shape[2:])
+
+    #Summing in integers and rounding, so nothing has to go through floats
+    block_size = factor*factor
+    total = blocks.sum(axis=(1, 3), dtype=np.uint32)
+    return ((total + block_size//2) // block_size).astype(np.uint8)
+
+def downsample_image_tensor(image, factor):
+    '''
+    Same as downsample_image, but for a torch tensor, staying on whatever device
+    the tensor is on. Gives exactly the same pixels downsample_image would.
+    '''
+    import torch
+
+    if factor == 1:
+        return image
+
+    height = image.shape[0] // factor
+    width = image.shape[1] // factor
+    blocks = image[:height*factor, :width*factor].reshape((height, factor, width, factor) + tuple(image.shape[2:]))
+
+    block_size = factor*factor
+    total = blocks.to(torch.int32).sum(dim=(1, 3))
+    return ((total + block_size//2) // block_size).to(torch.uint8)
+
 def build_mesh_from_points(points, line_height):
     '''
     Given a list of points defining a two-dimensional line, will build a mesh of
     a 3D representation of the line by essentially extruding it upwards.
     points is the list of points to build a mesh off of
     line_height is the height of the line
-    Returns a list of points for the new 3D shape, as well as a list of indices
-    into this list, defining the triangles of the generated mesh.
+    Returns an array of points for the new 3D shape, as well as an array of indices
+    into these points, defining the triangles of the generated mesh.
     '''
-    point_count = len(points)
-    second_layer = np.array(points) + np.array([0,0,line_height])
-    indices = []
+    points = np.asarray(points, dtype=np.float64)
+    pc = len(points)
 
     #Front Face
-    indices += [[0,point_count+1,1],[0,point_count,point_count+1]]
+    front = [[0,pc+1,1],[0,pc,pc+1]]
 
     #Back Face
-    indices += [[point_count-2,point_count-1,(point_count*2)-1],[point_count-2,(point_count*2)-1,(point_count*2)-2]]
+    back = [[pc-2,pc-1,(pc*2)-1],[pc-2,(pc*2)-1,(pc*2)-2]]
+
+    #Each pair of points along the line adds 8 triangles, so fill them in a face at a time
+    i = np.arange(0, pc-2, 2)
+    sides = np.empty((8*len(i), 3), dtype=np.int32)
+
+    #Bottom layer
+    sides[0::8] = np.stack([i, i+1, i+3], axis=1)
+    sides[1::8] = np.stack([i, i+3, i+2], axis=1)
+    #Top Layer
+    sides[2::8] = np.stack([pc+i, pc+i+3, pc+i+1], axis=1)
+    sides[3::8] = np.stack([pc+i, pc+i+2, pc+i+3], axis=1)
+    #Right Layer
+    sides[4::8] = np.stack([i, i+2, i+pc], axis=1)
+    sides[5::8] = np.stack([i+2, i+2+pc, i+pc], axis=1)
+    #Left Layer
+    sides[6::8] = np.stack([i+1, i+1+pc, i+3], axis=1)
+    sides[7::8] = np.stack([i+3, i+1+pc, i+3+pc], axis=1)
+
+    indices = np.concatenate([np.array(front + back, dtype=np.int32), sides])
+
+    points = np.vstack([points, points + np.array([0,0,line_height])])
+    return points, indices
 
-    i=0
-    while i < point_count-2:
+@njit(cache=True)
+def _set_triangle(faces, f, a, b, c):
+    faces[f, 0] = a
+    faces[f, 1] = b
+    faces[f, 2] = c
+
+@njit(cache=True)
+def extrude_lines(points, line_lengths, width, height):
+    '''
+    Does what get_corner_normals and build_mesh_from_points do together, for many
+    lines at once, building one mesh of a 3D representation of all of them with
+    the given width and height.
+    points is every line's points one after another, and line_lengths is how many
+    points are in each line. Each line needs at least 2 points.
+    Returns the vertices and indices of the whole mesh, with the vertices of each
+    line coming 4 per point in the same order as the lines, and each line's
+    triangles in the same order build_mesh_from_points gives.
+    '''
+    #Each line of n points always makes 4n vertices and 8n - 4 triangles, so we know how much room they all need
+    total_points = 0
+    for n in line_lengths:
+        total_points += n
+    verts = np.empty((4*total_points, 3))
+    faces = np.empty((8*total_points - 4*len(line_lengths), 3), dtype=np.int32)
+
+    p = 0
+    v = 0
+    f = 0
+    for n in line_lengths:
+        _extrude_line_into(points[p:p + n], width, height, verts[v:v + 4*n], faces[f:f + 8*n - 4], v)
+        p += n
+        v += 4*n
+        f += 8*n - 4
+
+    return verts, faces
+
+@njit(cache=True, inline="always")
+def _segment_normal(line, s):
+    #Normal of the segment from point s to point s+1, rotated by 90° the same way get_corner_normals does
+    return -(line[s + 1, 1] - line[s, 1]), line[s + 1, 0] - line[s, 0]
+
+@njit(cache=True)
+def _nearest_segment_normal(line, i):
+    '''
+    Gets the normal of the segment closest to point i that actually has some
+    length, checking the segment before a point before the one after it. Only
+    used when the segments right around point i are zero length, such as when
+    the same point shows up twice in a row. If the whole line is one point,
+    just gives back a normal pointing along x so the result is still finite.
+    '''
+    n = len(line)
+    for d in range(n):
+        if i - 1 - d >= 0:
+            x, y = _segment_normal(line, i - 1 - d)
+            if math.hypot(x, y) >= _ANTIPARALLEL_EPSILON:
+                return x, y
+        if i + d < n - 1:
+            x, y = _segment_normal(line, i + d)
+            if math.hypot(x, y) >= _ANTIPARALLEL_EPSILON:
+                return x, y
+    return 1.0, 0.0
+
+@njit(cache=True, inline="always")
+def _corner_normal(line, i, width):
+    '''
+    Gets the normal of the given line at point i, scaled to width, by rotating
+    the line segments around it by 90°, same as get_corner_normals. Rotating by
+    exactly 90° is just swapping x and y and flipping a sign, so there's no need
+    for any trig here. Inlined into _extrude_line_into, so the normal never has
+    to be put into an array.
+    Unlike get_corner_normals, this never divides by zero. If the segments around
+    point i have no length, the nearest segment that does is used instead.
+    '''
+    n = len(line)
+
+    #The very first and very last points just use the normal of their only segment
+    if i == 0:
+        normal_x, normal_y = _segment_normal(line, 0)
+    elif i == n - 1:
+        normal_x, normal_y = _segment_normal(line, n - 2)
+    else:
+        last_x, last_y = _segment_normal(line, i - 1)
+        next_x, next_y = _segment_normal(line, i)
+
+        if math.hypot(last_x + next_x, last_y + next_y) < _ANTIPARALLEL_EPSILON:
+            #Both segments are negatives of eachother, so adding them would give the 0 vector
+            normal_x = last_x
+            normal_y = last_y
+        else:
+            normal_x = last_x + next_x
+            normal_y = last_y + next_y
+
+    #Zero length segments have no direction, so borrow the normal of the nearest one that does
+    magnitude = math.hypot(normal_x, normal_y)
+    if magnitude < _ANTIPARALLEL_EPSILON:
+        normal_x, normal_y = _nearest_segment_normal(line, i)
+        magnitude = math.hypot(normal_x, normal_y)
+
+    #Scaling result back to width
+    scale = width / magnitude
+    return normal_x*scale, normal_y*scale
+
+@njit(cache=True)
+def _extrude_line_into(line, width, height, verts, faces, base_vert_index):
+    '''
+    Does the work for extrude_lines, writing the vertices and indices for a line
+    of N points into the given arrays, which must have room for exactly 4N
+    vertices and 8N - 4 triangles. base_vert_index is added on to every index,
+    since the vertices come after the ones for earlier lines.
+    '''
+    n = len(line)
+    pc = 2*n
+
+    for i in range(n):
+        normal_x, normal_y = _corner_normal(line, i, width)
+
+        #Corner points on the bottom layer, then the same points on the top layer
+        for layer in range(2):
+            v = layer*pc + 2*i
+            z = line[i, 2] + layer*height
+            verts[v, 0] = line[i, 0] + normal_x
+            verts[v, 1] = line[i, 1] + normal_y
+            verts[v, 2] = z
+            verts[v + 1, 0] = line[i, 0] - normal_x
+            verts[v + 1, 1] = line[i, 1] - normal_y
+            verts[v + 1, 2] = z
+
+    #Front Face
+    _set_triangle(faces, 0, 0, pc+1, 1)
+    _set_triangle(faces, 1, 0, pc, pc+1)
+
+    #Back Face
+    _set_triangle(faces, 2, pc-2, pc-1, (pc*2)-1)
+    _set_triangle(faces, 3, pc-2, (pc*2)-1, (pc*2)-2)
+
+    for k in range(n - 1):
+        i = 2*k
+        f = 4 + 8*k
         #Bottom layer
-        indices += [[i,i+1,i+3],[i,i+3,i+2]]
+        _set_triangle(faces, f, i, i+1, i+3)
+        _set_triangle(faces, f+1, i, i+3, i+2)
         #Top Layer
-        indices += [[point_count+i,point_count+i+3,point_count+i+1],[point_count+i,point_count+i+2,point_count+i+3]]
+        _set_triangle(faces, f+2, pc+i, pc+i+3, pc+i+1)
+        _set_triangle(faces, f+3, pc+i, pc+i+2, pc+i+3)
         #Right Layer
-        indices += [[i,i+2,i+point_count],[i+2,i+2+point_count,i+point_count]]
+        _set_triangle(faces, f+4, i, i+2, i+pc)
+        _set_triangle(faces, f+5, i+2, i+2+pc, i+pc)
         #Left Layer
-        indices += [[i+1,i+1+point_count,i+3],[i+3,i+1+point_count,i+3+point_count]]
-        i+=2
+        _set_triangle(faces, f+6, i+1, i+1+pc, i+3)
+        _set_triangle(faces, f+7, i+3, i+1+pc, i+3+pc)
 
-    points += list(second_layer)
-    return points, indices
+    faces += base_vert_index
@@ -1,8 +1,11 @@
 import utils
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
 import pyrender
 from io import BytesIO
 import skimage.io as io
 import numpy as np
+from scipy.spatial.transform import Rotation
 import trimesh
 import requests
 import matplotlib.pyplot as plt
@@ -19,10 +22,10 @@ class WatchDog():
         while secondary_color is the color of the material being extruded from hotend 1.
         As such, secondary_color's default is a PVA-ish color.
         '''
-        self.camera_pos = camera_pos
-        self.camera_fov = camera_fov
-        self.camera_rot = camera_rot
-        self.aspect_ratio = aspect_ratio
+        self._camera_pos = tuple(camera_pos)
+        self._camera_fov = camera_fov
+        self._camera_rot = tuple(camera_rot)
+        self._aspect_ratio = aspect_ratio
         self.nozzle_width = nozzle_width
         self.main_color = main_color
         self.secondary_color = secondary_color
@@ -30,6 +33,50 @@ class WatchDog():
         self.layers = []
         self.secondary_layers = []
 
+        #Reused between renders, since making a new OffscreenRenderer sets up a whole new GL context
+        self._renderer_cache = {}
+        self._render_pool = None
+        self._rebuild_camera()
+        self._rebuild_camera_pose()
+
+    #Changing any of the camera's settings rebuilds the cached camera or its pose right away, so renders never use stale values.
+    #camera_pos and camera_rot are kept as tuples so they can't be changed in place without us noticing.
+    @property
+    def camera_pos(self):
+        return self._camera_pos
+
+    @camera_pos.setter
+    def camera_pos(self, camera_pos):
+        self._camera_pos = tuple(camera_pos)
+        self._rebuild_camera_pose()
+
+    @property
+    def camera_rot(self):
+        return self._camera_rot
+
+    @camera_rot.setter
+    def camera_rot(self, camera_rot):
+        self._camera_rot = tuple(camera_rot)
+        self._rebuild_camera_pose()
+
+    @property
+    def camera_fov(self):
+        return self._camera_fov
+
+    @camera_fov.setter
+    def camera_fov(self, camera_fov):
+        self._camera_fov = camera_fov
+        self._rebuild_camera()
+
+    @property
+    def aspect_ratio(self):
+        return self._aspect_ratio
+
+    @aspect_ratio.setter
+    def aspect_ratio(self, aspect_ratio):
+        self._aspect_ratio = aspect_ratio
+        self._rebuild_camera()
+
     def read_layers_from_file(self, filename):
         #18 for nozzle offset because we're assuming we're on an Ultimaker 3 here
         self.layers, self.secondary_layers = utils.parse_gcode_file(filename, 18)
@@ -45,7 +92,7 @@ class WatchDog():
            [0.0,  1.0, 0.0, light_pos[1]],
            [0.0,  0.0, 1.0, light_pos[2]],
            [0.0,  0.0, 0.0, 1.0],
-        ])
+        ], dtype=np.float32)
         self.lights.append([pyrender.PointLight(color=light_color, intensity=light_intensity, range=light_range), translation])
 
     def build_object_mesh(self, main_layers, secondary_layers, height):
@@ -54,149 +101,321 @@ class WatchDog():
         printed, while secondary_layers will typically the support material for that object.
         height is the number of layers to render from the bottom up.
         If the print is a single material print, give an empty list for the respective variable
+        The mesh skips trimesh's processing and validation, which is only safe because
+        repeated points are dropped here and utils.extrude_lines always gives finite
+        vertices and triangles that only point at vertices of their own line.
         '''
 
-        vertices = []
-        indices = []
+        main_lines = []
+        secondary_lines = []
 
         if main_layers != []:
             for layer in main_layers[:height]:
-                for line in layer:
-                    if len(line) > 1:
-                        normal_points = utils.get_corner_normals(line, 0.2)
-                        new_vertices, new_indices = utils.build_mesh_from_points(normal_points, 0.2)
-                        new_indices = list(np.array(new_indices) + len(vertices))
-                        vertices += new_vertices
-                        indices += new_indices
-
-        main_object_vertices = len(vertices)
-
+                main_lines += [line for line in layer if len(line) > 1]
 
         if secondary_layers != []:
             for layer in secondary_layers[:height]:
-                for line in layer:
-                    if len(line) > 1:
-                        normal_points = utils.get_corner_normals(line, 0.2)
-                        new_vertices, new_indices = utils.build_mesh_from_points(normal_points, 0.2)
-                        new_indices = list(np.array(new_indices) + len(vertices))
-                        vertices += new_vertices
-                        indices += new_indices
+                secondary_lines += [line for line in layer if len(line) > 1]
 
-        secondary_vertices = len(vertices) - main_object_vertices
+        lines = main_lines + secondary_lines
+        line_lengths = np.array([len(line) for line in lines], dtype=np.int64)
+        points = np.array([point for line in lines for point in line], dtype=np.float64).reshape(-1, 3)
 
-        colors = [self.main_color] * main_object_vertices + [self.secondary_color] * secondary_vertices
+        """
+        Dropping any point at the same XY as the point before it in the same line,
+        which happens when a travel move is followed by an extrusion that starts
+        where the travel ended. There's no direction to extrude in between the two,
+        so they'd only give us zero length segments. Lines left with a single point
+        have nothing to extrude and get dropped altogether.
+        """
+        line_ids = np.repeat(np.arange(len(lines)), line_lengths)
+        keep = np.ones(len(points), dtype=bool)
+        keep[1:] = np.any(points[1:, :2] != points[:-1, :2], axis=1) | (line_ids[1:] != line_ids[:-1])
+        line_lengths = np.bincount(line_ids[keep], minlength=len(lines))
+        keep &= (line_lengths > 1)[line_ids]
+        line_lengths[line_lengths < 2] = 0
 
-        return trimesh.Trimesh(vertices=vertices, faces=indices, vertex_colors=colors)
+        points = points[keep]
 
-    def render_mesh(self, mesh, width, height):
-        # for i in range(20):
-        scene = pyrender.Scene()
+        #Every point of a line turns into 4 vertices
+        main_object_vertices = 4*int(line_lengths[:len(main_lines)].sum())
+        secondary_vertices = 4*int(line_lengths[len(main_lines):].sum())
 
-        #Adding the mesh into the scene
-        scene.add(pyrender.Mesh.from_trimesh(mesh))
+        line_lengths = line_lengths[line_lengths > 0]
 
-        #Adding the camera into the scene
-        camera = pyrender.PerspectiveCamera(yfov=self.camera_fov, aspectRatio=self.aspect_ratio)
-
-        pitch_cos = np.cos(self.camera_rot[0])
-        pitch_sin = np.sin(self.camera_rot[0])
-
-        roll_cos = np.cos(self.camera_rot[1])
-        roll_sin = np.sin(self.camera_rot[1])
-
-        yaw_cos = np.cos(self.camera_rot[2])
-        yaw_sin = np.sin(self.camera_rot[2])
-
-        pitch = np.mat([
-            [1.0, 0.0, 0.0, 0.0],
-            [0.0, pitch_cos,-pitch_sin, 0.0],
-            [0.0, pitch_sin, pitch_cos, 0.0],
-            [0.0, 0.0, 0.0, 1.0]
-        ])
-
-        roll = np.mat([
-            [roll_cos, 0.0, roll_sin, 0.0],
-            [0.0, 1.0, 0.0, 0.0],
-            [-roll_sin, 0.0, roll_cos, 0.0],
-            [0.0, 0.0, 0.0, 1.0]
-        ])
-
-        yaw = np.mat([
-            [yaw_cos, -yaw_sin, 0.0, 0.0],
-            [yaw_sin, yaw_cos, 0.0, 0.0],
-            [0.0, 0.0, 1.0, 0.0],
-            [0.0, 0.0, 0.0, 1.0]
-        ])
-
-        camera_transform = np.mat([
-            [1.0, 0.0, 0.0, self.camera_pos[0]],
-            [0.0, 1.0, 0.0, self.camera_pos[1]],
-            [0.0, 0.0, 1.0, self.camera_pos[2]],
-            [0.0, 0.0, 0.0, 1.0]
-        ])
-
-        s = np.sqrt(2)/2
-        camera_pose = np.mat([
-           [1.0, 0.0,   0.0,   0.0],
-           [0.0,  1.0, 0.0, 0.0],
-           [0.0,  0.0,   1.0,   0.0],
-           [0.0,  0.0, 0.0, 1.0],
-        ])
+        vertices, indices = utils.extrude_lines(points, line_lengths, 0.2, 0.2)
+
+        colors = np.empty((main_object_vertices + secondary_vertices, len(self.main_color)))
+        colors[:main_object_vertices] = self.main_color
+        colors[main_object_vertices:] = self.secondary_color
 
-        #Multiply yaw*roll*pitch
-        camera_rotation = yaw*roll*pitch
-        camera_pose = camera_transform*camera_rotation*camera_pose#*camera_z_rot*camera_y_rot*camera_x_rot
+        #We built the topology ourselves and it's always finite, so there's nothing for trimesh to clean up or check
+        return trimesh.Trimesh(vertices=vertices, faces=indices, vertex_colors=colors, process=False, validate=False)
 
+    def _rebuild_camera(self):
+        #Kept between renders, and only made again when the field of view or aspect ratio changes
+        self._camera = pyrender.PerspectiveCamera(yfov=self.camera_fov, aspectRatio=self.aspect_ratio)
 
-        scene.add(camera, pose=np.array(camera_pose))
+    def _rebuild_camera_pose(self):
+        '''
+        Builds the pose of the camera from camera_pos and camera_rot. This only needs
+        to happen when one of them changes, so it's called from __init__ and their
+        setters rather than on every render.
+        '''
+        #Rotating by yaw*roll*pitch, which is yaw around z, then roll around the new y, then pitch around the new x
+        rotation = Rotation.from_euler("ZYX", [self.camera_rot[2], self.camera_rot[1], self.camera_rot[0]])
+
+        camera_pose = np.eye(4, dtype=np.float32)
+        camera_pose[:3, :3] = rotation.as_matrix()
+        camera_pose[:3, 3] = self.camera_pos
+
+        self._camera_pose = camera_pose
+
+    def render_mesh(self, mesh, width, height):
+        return self.render_meshes([mesh], width, height)[0]
+
+    def render_meshes(self, meshes, width, height):
+        '''
+        Renders each of the given meshes from the camera, returning a list with an
+        image for each. The scene, camera and lights are only set up once, and just
+        the mesh is swapped out between renders.
+        '''
+        scene = pyrender.Scene()
+
+        #Adding the camera into the scene
+        scene.add(self._camera, pose=self._camera_pose)
 
         #Adding lights into the scene
         for light in self.lights:
             scene.add(light[0], pose=light[1])
 
-        #Render the scene and return the resultant image
-        r = pyrender.OffscreenRenderer(width, height)
-        color, depth = r.render(scene)
-            # io.imsave(str(i)+"_test.png", color)
-        return color
+        r = self._renderer_cache.get((width, height))
+        if r is None:
+            r = pyrender.OffscreenRenderer(width, height)
+            self._renderer_cache[(width, height)] = r
+
+        images = []
+        for mesh in meshes:
+            #Adding the mesh into the scene, rendering it, then taking it back out for the next one
+            mesh_node = scene.add(pyrender.Mesh.from_trimesh(mesh))
+            color, depth = r.render(scene)
+            scene.remove_node(mesh_node)
+            images.append(color)
+
+        return images
+
+    def render_heights(self, heights, width, height, max_workers=1):
+        '''
+        Renders the object as it would look after printing each of the given numbers
+        of layers, such as for comparing against pictures taken while it printed.
+        Returns a list with an image for each height.
+        If max_workers is more than 1, the heights are split between that many
+        processes, each with its own renderer, since rendering is bound to the CPU
+        and can't be spread across threads. The processes are kept around for later
+        calls until close() is called, or until the camera, colors, lights or layers
+        they were started with change.
+        '''
+        if max_workers == 1:
+            meshes = (self.build_object_mesh(self.layers, self.secondary_layers, h) for h in heights)
+            return self.render_meshes(meshes, width, height)
+
+        heights = list(heights)
+        images = [None] * len(heights)
+
+        executor = self._get_render_pool(max_workers)
+        futures = {executor.submit(_render_height, h, width, height): i for i, h in enumerate(heights)}
+        for future in as_completed(futures):
+            images[futures[future]] = future.result()
+
+        return images
+
+    def _get_render_pool(self, max_workers):
+        '''
+        Returns the worker processes for render_heights, only starting new ones if
+        there aren't any yet, or if anything they were set up with has changed
+        since they were started.
+        '''
+        watchdog_args = (self.camera_pos, self.camera_rot, self.camera_fov, self.aspect_ratio, self.nozzle_width, self.main_color, self.secondary_color)
+        pool_settings = (max_workers, watchdog_args, len(self.lights))
+
+        #Layers can be huge, so they're checked by identity instead of being compared
+        pool_objects = (self.lights, self.layers, self.secondary_layers)
+
+        if self._render_pool is not None:
+            if self._render_pool_settings == pool_settings and all(a is b for a, b in zip(self._render_pool_objects, pool_objects)):
+                return self._render_pool
+            self._render_pool.shutdown()
+
+        #Spawning instead of forking, so each worker sets up its GL context from scratch
+        self._render_pool = ProcessPoolExecutor(
+            max_workers=max_workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_render_worker,
+            initargs=(watchdog_args, self.lights, self.layers, self.secondary_layers)
+        )
+        self._render_pool_settings = pool_settings
+        self._render_pool_objects = pool_objects
+        return self._render_pool
+
+    def close(self):
+        '''
+        Shuts down the worker processes from render_heights and frees the renderers
+        kept between renders. The WatchDog can still be used afterwards, they'll
+        just be made again when they're needed.
+        '''
+        if self._render_pool is not None:
+            self._render_pool.shutdown()
+            self._render_pool = None
+
+        for r in self._renderer_cache.values():
+            r.delete()
+        self._renderer_cache = {}
+
+    def render_mesh_gpu(self, mesh, width, height, device="cuda"):
+        '''
+        Renders the mesh with PyTorch3D's rasterizer instead of pyrender, so it can run
+        on the GPU. Returns the image as an (height, width, 3) uint8 tensor left on the
+        given device, ready to go into compare_images_gpu.
+        The background is white and there's no ambient light, same as pyrender's
+        defaults in render_meshes, so empty pixels and unlit faces match between the
+        two. PyTorch3D's lights don't fall off with distance like pyrender's do and
+        add a specular highlight of their own, though, so only the position and color
+        of the first light are used, and the shading won't exactly match render_mesh.
+        '''
+        import torch
+        from pytorch3d.structures import Meshes
+        from pytorch3d.renderer import (BlendParams, FoVPerspectiveCameras, MeshRasterizer,
+            MeshRenderer, PointLights, RasterizationSettings, SoftPhongShader, TexturesVertex)
+
+        vertices = torch.as_tensor(np.asarray(mesh.vertices), dtype=torch.float32, device=device)
+        faces = torch.as_tensor(np.asarray(mesh.faces), dtype=torch.int64, device=device)
+        colors = torch.as_tensor(np.asarray(mesh.visual.vertex_colors)[:, :3] / 255.0, dtype=torch.float32, device=device)
+        meshes = Meshes(verts=[vertices], faces=[faces], textures=TexturesVertex(verts_features=[colors]))
+
+        """
+        Our camera pose is an OpenGL style camera-to-world transform, while PyTorch3D
+        wants a world-to-camera rotation and translation for row vectors, with the
+        camera's x and z axes flipped.
+        """
+        pose = self._camera_pose
+        R = pose[:3, :3] @ np.diag([-1.0, 1.0, -1.0])
+        T = -pose[:3, 3] @ R
+
+        """
+        PyTorch3D fits the shorter side of the image to its field of view and treats
+        aspect_ratio as the shape of a pixel, while pyrender always fits the height
+        and stretches the width by aspect_ratio, so we convert between the two here.
+        """
+        fov = 2*np.arctan(np.tan(self.camera_fov/2) * min(width, height) / height)
+        aspect_ratio = self.aspect_ratio * height / width
+
+        cameras = FoVPerspectiveCameras(
+            device=device,
+            R=torch.as_tensor(R[None], dtype=torch.float32),
+            T=torch.as_tensor(T[None], dtype=torch.float32),
+            fov=np.degrees(fov),
+            aspect_ratio=aspect_ratio,
+            znear=0.05,
+            zfar=10000.0
+        )
+
+        if self.lights != []:
+            light, light_pose = self.lights[0]
+            lights = PointLights(device=device, location=[tuple(light_pose[:3, 3])], diffuse_color=[tuple(light.color)], ambient_color=[(0.0, 0.0, 0.0)])
+        else:
+            #With no lights pyrender leaves everything unlit, so turn every part of the default light off
+            lights = PointLights(device=device, ambient_color=[(0.0, 0.0, 0.0)], diffuse_color=[(0.0, 0.0, 0.0)], specular_color=[(0.0, 0.0, 0.0)])
+
+        renderer = MeshRenderer(
+            rasterizer=MeshRasterizer(
+                cameras=cameras,
+                raster_settings=RasterizationSettings(image_size=(height, width), blur_radius=0.0, faces_per_pixel=1)
+            ),
+            shader=SoftPhongShader(device=device, cameras=cameras, lights=lights, blend_params=BlendParams(background_color=(1.0, 1.0, 1.0)))
+        )
+
+        image = renderer(meshes)[0, ..., :3]
+        return (image * 255).round().clamp(0, 255).to(torch.uint8)
 
     def test_compare_images(self, real, rendered):
-        new_image = 3*(np.array(real)//4) + np.array(rendered)//4
+        #Blending 3/4 real with 1/4 rendered, in a single uint16 buffer so nothing can overflow
+        new_image = np.array(real, dtype=np.uint16)
+        new_image *= 3
+        new_image += np.asarray(rendered, dtype=np.uint8)
+        new_image >>= 2
+        new_image = new_image.astype(np.uint8)
         io.imsave("new.png", new_image)
         # plt.imshow(new_image)
         # plt.show()
 
-    def compare_images(self, real, rendered, empty_value, threshold):
+    def compare_images(self, real, rendered, empty_value, threshold, downsample=4):
         """
         real is the real image taken
         rendered is the image we've rendered to compare to it
         empty_value should the value used for transparent pixels in rendered
+        downsample is how many times smaller to shrink both images before comparing
+        them, which is much faster but compares averaged blocks of pixels instead of
+        single pixels. A block only counts as empty if it averages out to empty_value.
+        Use 1 to compare at full resolution.
         """
+        real = utils.downsample_image(real, downsample)
+        rendered = utils.downsample_image(rendered, downsample)
 
+        #Only compare pixels that aren't empty
+        mask = ~np.all(real == empty_value, axis=-1)
 
-        real = np.array(real)
-        rendered = np.array(rendered)
+        #Casting up first so the subtraction can't wrap around
+        difference = real.astype(np.int16) - rendered.astype(np.int16)
 
-        difference = real - rendered
+        #Comparing the sum over each pixel's channels instead of the mean, so it all stays in integers
+        channels = difference.shape[-1]
+        difference = difference.sum(axis=-1, dtype=np.int16)
 
-        total_pixels_compared = 0
-        pixels_below_threshold = 0
+        total_pixels_compared = np.count_nonzero(mask)
+        if total_pixels_compared == 0:
+            raise ValueError("every pixel in real is empty_value, so there's nothing to compare")
+        pixels_below_threshold = np.count_nonzero((difference < threshold*channels) & mask)
 
-        for i in range(difference.shape[0]):
-            for j in range(difference.shape[1]):
-                if np.array_equal(real[i,j], empty_value):
-                    continue
+        return pixels_below_threshold / total_pixels_compared
 
-                total_pixels_compared += 1
-                if np.mean(difference[i,j]) < threshold:
-                    pixels_below_threshold += 1
+    def compare_images_gpu(self, real, rendered, empty_value, threshold, downsample=4):
+        """
+        Same as compare_images, but for a rendered image that's a tensor, like the ones
+        from render_mesh_gpu. real is moved over to the same device as rendered, and
+        the whole comparison runs there, giving the same result compare_images would.
+        """
+        import torch
 
-        # mask = (real == empty_value)
-        #
-        # difference = real - rendered
-        # difference = difference + (mask * threshold)
-        #
-        # pixel_count = difference.shape[0]*difference.shape[1]
-        # comparison_pixel_count = pixel_count - np.sum(mask)
+        real = torch.as_tensor(np.asarray(real), device=rendered.device)
 
-        return pixels_below_threshold / total_pixels_compared
+        real = utils.downsample_image_tensor(real, downsample)
+        rendered = utils.downsample_image_tensor(rendered, downsample)
+
+        #Only compare pixels that aren't empty
+        mask = ~torch.all(real == torch.as_tensor(empty_value, device=rendered.device), dim=-1)
+
+        #Casting up first so the subtraction can't wrap around
+        difference = real.to(torch.int16) - rendered.to(torch.int16)
+
+        #Comparing the sum over each pixel's channels instead of the mean, so it all stays in integers
+        channels = difference.shape[-1]
+        difference = difference.sum(dim=-1, dtype=torch.int16)
+
+        total_pixels_compared = torch.count_nonzero(mask).item()
+        if total_pixels_compared == 0:
+            raise ValueError("every pixel in real is empty_value, so there's nothing to compare")
+        pixels_below_threshold = torch.count_nonzero((difference < threshold*channels) & mask)
+
+        return pixels_below_threshold.item() / total_pixels_compared
+
+#The WatchDog each render_heights worker process renders with, so its renderer is reused for every height it gets
+_worker_watchdog = None
+
+def _init_render_worker(watchdog_args, lights, layers, secondary_layers):
+    global _worker_watchdog
+    _worker_watchdog = WatchDog(*watchdog_args)
+    _worker_watchdog.lights = lights
+    _worker_watchdog.set_layers(layers, secondary_layers)
+
+def _render_height(height, width, image_height):
+    return _worker_watchdog.render_heights([height], width, image_height)[0]